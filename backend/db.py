@@ -1,6 +1,9 @@
 import sqlite3
 import os
 import json
+import time
+import queue
+import threading
 from datetime import datetime
 import logging
 
@@ -14,6 +17,166 @@ logger = logging.getLogger('db')
 # Database configuration
 DB_PATH = os.getenv('DB_PATH', 'sensor_data.db')
 
+# String values that count as True for 'bool' settings
+_TRUTHY_STR = frozenset(('true', '1', 'yes', 'y', 'on'))
+
+# In-memory cache for vitals history reads, keyed by (vital_type, limit).
+# Both come from the request URL, so the cache is capped at VITALS_CACHE_MAX
+# entries and expired ones are dropped whenever a new one is stored.
+VITALS_CACHE_TTL = int(os.getenv('VITALS_CACHE_TTL', 60))
+VITALS_CACHE_MAX = int(os.getenv('VITALS_CACHE_MAX', 32))
+_vitals_cache = {}
+_vitals_cache_gen = 0
+_vitals_cache_lock = threading.Lock()
+
+def invalidate_vitals_cache(vital_type=None):
+    """Drop cached vitals history for one vital type, or all of them."""
+    global _vitals_cache_gen
+    with _vitals_cache_lock:
+        _vitals_cache_gen += 1
+        if vital_type is None:
+            _vitals_cache.clear()
+            return
+        for key in [k for k in _vitals_cache if k[0] == vital_type]:
+            _vitals_cache.pop(key, None)
+
+def _store_vitals_cache(key, value, generation):
+    """Cache a vitals read made at `generation` unless it has been invalidated since."""
+    with _vitals_cache_lock:
+        if generation != _vitals_cache_gen:
+            return
+        now = time.monotonic()
+        for k in [k for k, (expires, _) in _vitals_cache.items() if expires <= now]:
+            del _vitals_cache[k]
+        if key not in _vitals_cache and len(_vitals_cache) >= VITALS_CACHE_MAX:
+            # Dicts keep insertion order, so this drops the oldest entry
+            del _vitals_cache[next(iter(_vitals_cache))]
+        _vitals_cache[key] = (now + VITALS_CACHE_TTL, value)
+
+# Cache for the reads made on every state broadcast (recent BP/temperature,
+# settings, unacknowledged alert count). Entries are keyed (name, args) and
+# dropped by the matching writer, so the TTL is only a backstop. Histories
+# are only cached for the count broadcast_state asks for, so the keys stay
+# fixed whatever limits the API is called with.
+READ_CACHE_TTL = float(os.getenv('READ_CACHE_TTL', 60))
+_read_cache = {}
+# Bumped by every invalidation. A reader notes it before its query and only
+# stores the result if no write invalidated the cache in the meantime.
+_read_cache_gen = 0
+_read_cache_lock = threading.Lock()
+BROADCAST_HISTORY_COUNT = 5
+
+def invalidate_read_cache(name=None):
+    """Drop cached reads for one name ('bp', 'temp', 'settings', 'alerts_count'), or all."""
+    global _read_cache_gen
+    with _read_cache_lock:
+        _read_cache_gen += 1
+        if name is None:
+            _read_cache.clear()
+            return
+        for key in [k for k in _read_cache if k[0] == name]:
+            _read_cache.pop(key, None)
+
+def _store_read_cache(key, value, generation):
+    """Cache a read made at `generation` unless it has been invalidated since."""
+    with _read_cache_lock:
+        if generation == _read_cache_gen:
+            _read_cache[key] = (time.monotonic() + READ_CACHE_TTL, value)
+
+# Pulse ox readings arrive at ~5Hz. Rather than one connection and commit per
+# sample, ids are handed out up front and a background thread writes the
+# queued rows in batches every PULSE_OX_FLUSH_INTERVAL seconds.
+PULSE_OX_FLUSH_INTERVAL = float(os.getenv('PULSE_OX_FLUSH_INTERVAL', 0.5))
+_pulse_ox_queue = queue.Queue()
+_pulse_ox_lock = threading.Lock()
+_pulse_ox_next_id = None
+_pulse_ox_writer = None
+# Set by flush_pulse_ox_data to make the writer write what it has and exit;
+# no new writer is started while it is set
+_pulse_ox_stop = threading.Event()
+
+def _reserve_pulse_ox_id():
+    """Return the next pulse_ox_data id, starting the batch writer on first use."""
+    global _pulse_ox_next_id, _pulse_ox_writer
+    with _pulse_ox_lock:
+        if _pulse_ox_next_id is None:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                # AUTOINCREMENT never reuses ids, so start past both the
+                # highest row and the highest id ever handed out
+                row = conn.execute(
+                    '''
+                    SELECT MAX(
+                        COALESCE((SELECT MAX(id) FROM pulse_ox_data), 0),
+                        COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'pulse_ox_data'), 0)
+                    )
+                    '''
+                ).fetchone()
+            finally:
+                conn.close()
+            _pulse_ox_next_id = row[0] + 1
+        if not _pulse_ox_stop.is_set() and (_pulse_ox_writer is None or not _pulse_ox_writer.is_alive()):
+            _pulse_ox_writer = threading.Thread(target=_pulse_ox_writer_loop, daemon=True)
+            _pulse_ox_writer.start()
+        data_id = _pulse_ox_next_id
+        _pulse_ox_next_id += 1
+        return data_id
+
+def _drain_pulse_ox_queue():
+    """Take every row currently queued."""
+    rows = []
+    while True:
+        try:
+            rows.append(_pulse_ox_queue.get_nowait())
+        except queue.Empty:
+            return rows
+
+def _pulse_ox_writer_loop():
+    # Rows from a batch that failed to write; alerts may already reference
+    # their ids, so they are retried with the next batch rather than dropped
+    pending = []
+    while True:
+        # Collect a flush interval's worth of samples (returns early on stop)
+        stop = _pulse_ox_stop.wait(PULSE_OX_FLUSH_INTERVAL)
+        rows = pending + _drain_pulse_ox_queue()
+        pending = []
+        if rows:
+            try:
+                if save_pulse_ox_data_bulk(rows) is None:
+                    pending = rows
+            except Exception:
+                logger.exception("Pulse ox writer failed on a batch of %d rows", len(rows))
+                pending = rows
+            if pending:
+                logger.warning("Retrying %d unsaved pulse ox rows", len(pending))
+        if stop:
+            # Hand anything unsaved back for flush_pulse_ox_data's final attempt
+            for row in pending:
+                _pulse_ox_queue.put(row)
+            return
+
+def flush_pulse_ox_data():
+    """
+    Write any queued pulse ox readings now (e.g. at shutdown).
+    
+    Stops the writer thread and waits for it, so rows it was already holding
+    are written too. The next queued reading starts a new writer.
+    """
+    global _pulse_ox_writer
+    with _pulse_ox_lock:
+        writer = _pulse_ox_writer
+        _pulse_ox_stop.set()
+    if writer is not None:
+        writer.join()
+    
+    rows = _drain_pulse_ox_queue()
+    if rows:
+        save_pulse_ox_data_bulk(rows)
+    
+    with _pulse_ox_lock:
+        _pulse_ox_writer = None
+        _pulse_ox_stop.clear()
+
 def init_db():
     """Initialize the database with required tables."""
     try:
@@ -115,6 +278,13 @@ def init_db():
         )
         ''')
         
+        # Indexes matching the filters/sort orders used by the history queries
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_vitals_type_timestamp ON vitals (vital_type, timestamp DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_blood_pressure_timestamp ON blood_pressure (timestamp DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_temperature_timestamp ON temperature (timestamp DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_pulse_ox_data_timestamp ON pulse_ox_data (timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_monitoring_alerts_ack_start ON monitoring_alerts (acknowledged, start_time DESC)')
+        
         conn.commit()
         logger.info(f"Database initialized at {DB_PATH}")
     except sqlite3.Error as e:
@@ -149,6 +319,7 @@ def save_blood_pressure(systolic, diastolic, map_value, raw_data):
         )
         
         conn.commit()
+        invalidate_read_cache('bp')
         logger.info(f"Blood pressure saved: {systolic}/{diastolic} (MAP: {map_value})")
         return cursor.lastrowid
     except sqlite3.Error as e:
@@ -183,6 +354,7 @@ def save_temperature(skin_temp, body_temp, raw_data):
         )
         
         conn.commit()
+        invalidate_read_cache('temp')
         logger.info(f"Temperature saved: Skin: {skin_temp}°, Body: {body_temp}°")
         return cursor.lastrowid
     except sqlite3.Error as e:
@@ -219,6 +391,7 @@ def save_vital(vital_type, value, timestamp=None, notes=None):
         )
         
         conn.commit()
+        invalidate_vitals_cache(vital_type)
         logger.info(f"Vital saved: {vital_type}={value}")
         return cursor.lastrowid
     except sqlite3.Error as e:
@@ -228,6 +401,58 @@ def save_vital(vital_type, value, timestamp=None, notes=None):
         if conn:
             conn.close()
 
+def save_vitals(readings, timestamp=None, notes=None):
+    """
+    Save several generic vital readings with a single INSERT statement
+    
+    Args:
+        readings (list): List of (vital_type, value) tuples
+        timestamp (str, optional): Timestamp for the readings. Defaults to current time.
+        notes (str, optional): Additional notes applied to every reading.
+    
+    Returns:
+        list: IDs of the inserted records, or None on error
+    """
+    if not readings:
+        return []
+    
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        
+        now = datetime.now().isoformat()
+        timestamp = timestamp or now
+        
+        # One multi-row INSERT; AUTOINCREMENT ids within a single statement
+        # are consecutive, so they can be derived from the last rowid
+        placeholders = ', '.join(['(?, ?, ?, ?, ?)'] * len(readings))
+        params = []
+        for vital_type, value in readings:
+            params.extend((timestamp, vital_type, value, notes, now))
+        
+        cursor.execute(
+            f'''
+            INSERT INTO vitals 
+            (timestamp, vital_type, value, notes, created_at)
+            VALUES {placeholders}
+            ''',
+            params
+        )
+        
+        conn.commit()
+        last_id = cursor.lastrowid
+        ids = list(range(last_id - len(readings) + 1, last_id + 1))
+        for vital_type, _ in readings:
+            invalidate_vitals_cache(vital_type)
+        logger.info(f"Vitals saved: {', '.join(f'{t}={v}' for t, v in readings)}")
+        return ids
+    except sqlite3.Error as e:
+        logger.error(f"Error saving vitals: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
 def get_latest_blood_pressure():
     """Get the most recent blood pressure reading."""
     try:
@@ -300,6 +525,12 @@ def get_last_n_blood_pressure(n=5):
     Returns:
         list: List of dictionaries containing BP readings
     """
+    cache_key = ('bp', n)
+    cached = _read_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _read_cache_gen
+    
     try:
         conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row  # Return rows as dictionaries
@@ -328,8 +559,10 @@ def get_last_n_blood_pressure(n=5):
         
         # If we have no results, only add a single empty entry
         if len(bp_data) == 0:
-            return [{'datetime': '', 'systolic_bp': None, 'diastolic_bp': None, 'map_bp': None}]
+            bp_data = [{'datetime': '', 'systolic_bp': None, 'diastolic_bp': None, 'map_bp': None}]
             
+        if n == BROADCAST_HISTORY_COUNT:
+            _store_read_cache(cache_key, bp_data, generation)
         return bp_data
     except sqlite3.Error as e:
         logger.error(f"Error fetching blood pressure history: {e}")
@@ -349,6 +582,12 @@ def get_last_n_temperature(n=5):
     Returns:
         list: List of dictionaries containing temperature readings
     """
+    cache_key = ('temp', n)
+    cached = _read_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _read_cache_gen
+    
     try:
         conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row  # Return rows as dictionaries
@@ -376,8 +615,10 @@ def get_last_n_temperature(n=5):
         
         # If we have no results, only add a single empty entry
         if len(temp_data) == 0:
-            return [{'datetime': '', 'skin_temp': None, 'body_temp': None}]
+            temp_data = [{'datetime': '', 'skin_temp': None, 'body_temp': None}]
             
+        if n == BROADCAST_HISTORY_COUNT:
+            _store_read_cache(cache_key, temp_data, generation)
         return temp_data
     except sqlite3.Error as e:
         logger.error(f"Error fetching temperature history: {e}")
@@ -398,6 +639,12 @@ def get_vitals_by_type(vital_type, limit=100):
     Returns:
         list: List of dictionaries containing readings
     """
+    cache_key = (vital_type, limit)
+    cached = _vitals_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _vitals_cache_gen
+    
     try:
         conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row  # Return rows as dictionaries
@@ -424,6 +671,7 @@ def get_vitals_by_type(vital_type, limit=100):
             for row in results
         ]
         
+        _store_vitals_cache(cache_key, vitals_data, generation)
         return vitals_data
     except sqlite3.Error as e:
         logger.error(f"Error fetching {vital_type} history: {e}")
@@ -475,6 +723,7 @@ def save_setting(key, value, data_type="string", description=None):
             )
         
         conn.commit()
+        invalidate_read_cache('settings')
         logger.info(f"Setting saved: {key}={value}")
         return True
     except sqlite3.Error as e:
@@ -515,7 +764,7 @@ def get_setting(key, default=None):
         elif data_type == 'float':
             return float(value)
         elif data_type == 'bool':
-            return value.lower() in ('true', '1', 'yes', 'y')
+            return value.lower() in _TRUTHY_STR
         elif data_type == 'json':
             return json.loads(value)
         else:  # string or anything else
@@ -535,6 +784,11 @@ def get_all_settings():
     Returns:
         dict: Dictionary of all settings with proper type conversion
     """
+    cached = _read_cache.get(('settings',))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _read_cache_gen
+    
     try:
         conn = sqlite3.connect(DB_PATH)
         conn.row_factory = sqlite3.Row
@@ -555,7 +809,7 @@ def get_all_settings():
             elif data_type == 'float':
                 converted_value = float(value)
             elif data_type == 'bool':
-                converted_value = value.lower() in ('true', '1', 'yes', 'y')
+                converted_value = value.lower() in _TRUTHY_STR
             elif data_type == 'json':
                 converted_value = json.loads(value)
             else:  # string or anything else
@@ -568,6 +822,7 @@ def get_all_settings():
                 'updated_at': row['updated_at']
             }
             
+        _store_read_cache(('settings',), settings, generation)
         return settings
             
     except sqlite3.Error as e:
@@ -593,6 +848,7 @@ def delete_setting(key):
         
         cursor.execute("DELETE FROM settings WHERE key = ?", (key,))
         conn.commit()
+        invalidate_read_cache('settings')
         
         deleted = cursor.rowcount > 0
         if deleted:
@@ -633,13 +889,14 @@ def save_pulse_ox_data(spo2, bpm, pa, status=None, motion=None, spo2_alarm=None,
         now = datetime.now().isoformat()
         ts = timestamp or now  # Use provided timestamp or current time
         
+        # Ids come from the same counter as queued rows so they never collide
         cursor.execute(
             '''
             INSERT INTO pulse_ox_data
-            (timestamp, spo2, bpm, pa, status, motion, spo2_alarm, hr_alarm, raw_data, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (id, timestamp, spo2, bpm, pa, status, motion, spo2_alarm, hr_alarm, raw_data, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''',
-            (ts, spo2, bpm, pa, status, motion, spo2_alarm, hr_alarm, raw_data, now)
+            (_reserve_pulse_ox_id(), ts, spo2, bpm, pa, status, motion, spo2_alarm, hr_alarm, raw_data, now)
         )
         
         conn.commit()
@@ -653,6 +910,78 @@ def save_pulse_ox_data(spo2, bpm, pa, status=None, motion=None, spo2_alarm=None,
         if conn:
             conn.close()
 
+def queue_pulse_ox_data(spo2, bpm, pa, status=None, motion=None, spo2_alarm=None, hr_alarm=None, raw_data=None, timestamp=None):
+    """
+    Queue a pulse oximeter reading for the background batch writer
+    
+    Takes the same arguments as save_pulse_ox_data. The row is written
+    within PULSE_OX_FLUSH_INTERVAL seconds.
+    
+    Returns:
+        int: ID the record will be stored under
+    """
+    data_id = _reserve_pulse_ox_id()
+    _pulse_ox_queue.put({
+        'db_id': data_id,
+        'timestamp': timestamp,
+        'spo2': spo2,
+        'bpm': bpm,
+        'perfusion': pa,
+        'status': status,
+        'motion': motion,
+        'spo2_alarm': spo2_alarm,
+        'hr_alarm': hr_alarm,
+        'raw_data': raw_data
+    })
+    return data_id
+
+def save_pulse_ox_data_bulk(points):
+    """
+    Save several pulse oximeter readings in one transaction
+    
+    Args:
+        points (list): Dicts with spo2, bpm, perfusion, status, motion,
+            spo2_alarm, hr_alarm, raw_data and timestamp keys, plus an
+            optional db_id from queue_pulse_ox_data (a new id is reserved
+            when it is missing)
+    
+    Returns:
+        int: Number of records inserted, or None on error
+    """
+    if not points:
+        return 0
+    
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        
+        now = datetime.now().isoformat()
+        
+        cursor.executemany(
+            '''
+            INSERT INTO pulse_ox_data
+            (id, timestamp, spo2, bpm, pa, status, motion, spo2_alarm, hr_alarm, raw_data, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            [
+                (p.get('db_id') or _reserve_pulse_ox_id(), p.get('timestamp') or now,
+                 p['spo2'], p['bpm'], p['perfusion'], p['status'], p['motion'],
+                 p.get('spo2_alarm'), p.get('hr_alarm'), p.get('raw_data'), now)
+                for p in points
+            ]
+        )
+        
+        conn.commit()
+        logger.info(f"Pulse ox data saved: {len(points)} records")
+        return len(points)
+    except sqlite3.Error as e:
+        logger.error(f"Error saving pulse ox data batch: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
 def start_monitoring_alert(spo2=None, bpm=None, data_id=None, spo2_alarm_triggered=0, hr_alarm_triggered=0):
     """
     Start a new monitoring alert event
@@ -684,6 +1013,7 @@ def start_monitoring_alert(spo2=None, bpm=None, data_id=None, spo2_alarm_trigger
         )
         
         conn.commit()
+        invalidate_read_cache('alerts_count')
         alert_id = cursor.lastrowid
         logger.info(f"Started monitoring alert #{alert_id} - SpO2: {spo2}%, BPM: {bpm}")
         return alert_id
@@ -827,6 +1157,7 @@ def acknowledge_alert(alert_id):
         
         cursor.execute('UPDATE monitoring_alerts SET acknowledged = 1 WHERE id = ?', (alert_id,))
         conn.commit()
+        invalidate_read_cache('alerts_count')
         
         success = cursor.rowcount > 0
         if success:
@@ -849,6 +1180,11 @@ def get_unacknowledged_alerts_count():
     Returns:
         int: Number of unacknowledged alerts
     """
+    cached = _read_cache.get(('alerts_count',))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    generation = _read_cache_gen
+    
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
@@ -856,6 +1192,7 @@ def get_unacknowledged_alerts_count():
         cursor.execute('SELECT COUNT(*) FROM monitoring_alerts WHERE acknowledged = 0')
         count = cursor.fetchone()[0]
         
+        _store_read_cache(('alerts_count',), count, generation)
         return count
     except sqlite3.Error as e:
         logger.error(f"Error getting unacknowledged alert count: {e}")
@@ -12,7 +12,13 @@ from state_manager import (
     update_sensor, register_websocket_client, unregister_websocket_client,
     broadcast_state  # Make sure to import this too
 )
-from db import init_db, get_latest_blood_pressure, get_blood_pressure_history, get_last_n_temperature, save_blood_pressure, save_temperature, save_vital, get_all_settings, get_setting, save_setting, delete_setting
+from db import (
+    init_db, get_latest_blood_pressure, get_blood_pressure_history, get_last_n_temperature,
+    save_blood_pressure, save_temperature, save_vitals, get_vitals_by_type,
+    get_all_settings, get_setting, save_setting, delete_setting,
+    get_monitoring_alerts, get_unacknowledged_alerts_count, update_monitoring_alert,
+    acknowledge_alert, get_pulse_ox_data_for_alert, flush_pulse_ox_data
+)
 from mqtt_discovery import send_mqtt_discovery
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
@@ -43,24 +49,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-loop = asyncio.get_event_loop()
+async def broadcast_state_async():
+    """Run broadcast_state in a worker thread so its DB reads don't block the loop."""
+    await asyncio.get_running_loop().run_in_executor(None, broadcast_state)
 
 @app.on_event("startup")
 async def startup_event():
     global mqtt_client_ref
     
-    # Set the event loop
-    set_event_loop(asyncio.get_event_loop())
+    # Set the event loop. This is the loop uvicorn is serving on, which is
+    # uvloop whenever it is installed (uvicorn's default --loop auto)
+    loop = asyncio.get_running_loop()
+    set_event_loop(loop)
     print("[main] Event loop registered with state manager")
     
     # Initialize database
     init_db()
     
-    # Initialize default settings if they don't exist
-    from db import save_setting, get_setting
-
     reset_sensor_state()
     
+    # Initialize default settings if they don't exist
     # Device settings
     if get_setting("device_name") is None:
         save_setting("device_name", "Smart Home Health Monitor", "string", "Device name")
@@ -117,7 +125,6 @@ async def startup_event():
         print(f"[main] Failed to connect to MQTT broker: {e}")
     
     # 2) Wire in serial (hot-plug)
-    set_event_loop(loop)
     threading.Thread(target=serial_loop, daemon=True).start()
 
 @app.on_event("shutdown")
@@ -125,6 +132,10 @@ async def shutdown_event():
     # Use the global reference
     global mqtt_client_ref
     
+    # Write out pulse ox readings still waiting in the batch queue; this
+    # joins the writer thread, so keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, flush_pulse_ox_data)
+    
     if mqtt_client_ref:
         try:
             mqtt_client_ref.publish("medical/spo2/availability", "offline", retain=True)
@@ -142,15 +153,20 @@ async def websocket_endpoint(websocket: WebSocket):
     register_websocket_client(websocket)
     
     try:
+        # Send the current state right away; broadcasts otherwise only go
+        # out when a value changes, which may not happen for a while
+        await broadcast_state_async()
+        
         while True:
             # Just keep the connection alive
             data = await websocket.receive_text()
             # You can handle commands here if needed
     except WebSocketDisconnect:
         print(f"[main] WebSocket client disconnected: {websocket}")
-        unregister_websocket_client(websocket)
     except Exception as e:
         print(f"[main] WebSocket error: {e}")
+    finally:
+        # Always drop the client, including on cancellation at shutdown
         unregister_websocket_client(websocket)
 
 @app.get("/limits")
@@ -213,26 +229,38 @@ async def add_manual_vitals(vital_data: dict):
                 raw_data=json.dumps(temp)
             )
         
-        # Handle other vitals using the new generic vitals table
+        # Handle other vitals using the new generic vitals table,
+        # written together in one transaction
+        readings = []
         if nutrition and nutrition.get("calories"):
-            save_vital("calories", nutrition.get("calories"), datetime, notes)
+            readings.append(("calories", nutrition.get("calories")))
             
         if nutrition and nutrition.get("water_ml"):
-            save_vital("water", nutrition.get("water_ml"), datetime, notes)
+            readings.append(("water", nutrition.get("water_ml")))
             
         if weight:
-            save_vital("weight", weight, datetime, notes)
+            readings.append(("weight", weight))
+        
+        vitals_saved = save_vitals(readings, datetime, notes)
         
         # Force state update to include new readings
-        broadcast_state()
+        await broadcast_state_async()
         
-        return {"status": "success", "message": "Vitals saved successfully"}
+        return {"status": "success", "message": "Vitals saved successfully", "vitals_saved": vitals_saved}
     except Exception as e:
         print(f"Error saving manual vitals: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 # Add these endpoints after your existing endpoints
 
+@app.get("/api/vitals/nutrition")
+def get_nutrition_history(limit: int = 100):
+    """Get combined nutrition history (calories and water)"""
+    return {
+        "calories": get_vitals_by_type("calories", limit),
+        "water": get_vitals_by_type("water", limit)
+    }
+
 @app.get("/api/vitals/{vital_type}")
 def get_vital_history(vital_type: str, limit: int = 100):
     """
@@ -242,23 +270,8 @@ def get_vital_history(vital_type: str, limit: int = 100):
         vital_type: Type of vital (weight, calories, water, etc.)
         limit: Maximum number of records to return
     """
-    from db import get_vitals_by_type
     return get_vitals_by_type(vital_type, limit)
 
-@app.get("/api/vitals/nutrition")
-def get_nutrition_history(limit: int = 100):
-    """Get combined nutrition history (calories and water)"""
-    from db import get_vitals_by_type
-    return {
-        "calories": get_vitals_by_type("calories", limit),
-        "water": get_vitals_by_type("water", limit)
-    }
-
-# Add these imports
-from fastapi import Body, HTTPException
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
-
 # Add these models for request validation
 class SettingIn(BaseModel):
     value: Any
@@ -270,15 +283,13 @@ class SettingUpdate(BaseModel):
 
 # Add these endpoints
 @app.get("/api/settings")
-async def get_all_settings():
+async def get_all_settings_endpoint():
     """Get all settings"""
-    from db import get_all_settings
     return get_all_settings()
 
 @app.get("/api/settings/{key}")
-async def get_setting(key: str, default: Optional[str] = None):
+async def get_setting_endpoint(key: str, default: Optional[str] = None):
     """Get a specific setting by key"""
-    from db import get_setting
     value = get_setting(key, default)
     if value is None and default is None:
         raise HTTPException(status_code=404, detail=f"Setting {key} not found")
@@ -287,7 +298,6 @@ async def get_setting(key: str, default: Optional[str] = None):
 @app.post("/api/settings/{key}")
 async def set_setting(key: str, setting: SettingIn):
     """Set a specific setting"""
-    from db import save_setting
     success = save_setting(
         key=key,
         value=setting.value,
@@ -298,14 +308,13 @@ async def set_setting(key: str, setting: SettingIn):
         raise HTTPException(status_code=500, detail="Failed to save setting")
     
     # Use broadcast_state instead of broadcast_settings
-    broadcast_state()
+    await broadcast_state_async()
     
     return {"key": key, "value": setting.value, "status": "success"}
 
 @app.post("/api/settings")
 async def update_multiple_settings(settings: SettingUpdate):
     """Update multiple settings at once"""
-    from db import save_setting
     results = {}
     
     for key, value in settings.settings.items():
@@ -321,20 +330,19 @@ async def update_multiple_settings(settings: SettingUpdate):
         results[key] = "success" if success else "failed"
     
     # Use broadcast_state instead of broadcast_settings
-    broadcast_state()
+    await broadcast_state_async()
     
     return results
 
 @app.delete("/api/settings/{key}")
 async def delete_setting_endpoint(key: str):
     """Delete a setting"""
-    from db import delete_setting
     success = delete_setting(key)
     if not success:
         raise HTTPException(status_code=404, detail=f"Setting {key} not found")
     
     # Use broadcast_state instead of broadcast_settings
-    broadcast_state()
+    await broadcast_state_async()
     
     return {"status": "success", "message": f"Setting {key} deleted"}
 
@@ -347,17 +355,15 @@ async def get_monitoring_alerts_endpoint(
     detailed: bool = False
 ):
     """Get monitoring alerts"""
-    from db import get_monitoring_alerts
     return get_monitoring_alerts(limit, include_acknowledged, detailed)
 
 @app.get("/api/monitoring/alerts/count")
 async def get_unacknowledged_alerts_count_endpoint():
     """Get count of unacknowledged alerts"""
-    from db import get_unacknowledged_alerts_count
     return {"count": get_unacknowledged_alerts_count()}
 
 @app.post("/api/monitoring/alerts/{alert_id}/acknowledge")
-async def acknowledge_alert(alert_id: int, data: dict = Body(...)):
+async def acknowledge_alert_endpoint(alert_id: int, data: dict = Body(...)):
     """
     Acknowledge an alert and save oxygen usage data
     """
@@ -377,7 +383,6 @@ async def acknowledge_alert(alert_id: int, data: dict = Body(...)):
             oxygen_highest = None
         
         # Update the alert with oxygen information
-        from db import update_monitoring_alert, acknowledge_alert
         success = update_monitoring_alert(
             alert_id,
             oxygen_used=oxygen_used,
@@ -393,13 +398,11 @@ async def acknowledge_alert(alert_id: int, data: dict = Body(...)):
             if result:
                 return {"success": True, "message": "Alert acknowledged"}
             else:
-                from fastapi.responses import JSONResponse
                 return JSONResponse(
                     status_code=404, 
                     content={"detail": f"Alert {alert_id} not found"}
                 )
         else:
-            from fastapi.responses import JSONResponse
             return JSONResponse(
                 status_code=500,
                 content={"detail": f"Failed to update alert {alert_id}"}
@@ -407,7 +410,6 @@ async def acknowledge_alert(alert_id: int, data: dict = Body(...)):
     except Exception as e:
         # Now logger is defined
         logger.error(f"Error acknowledging alert: {e}", exc_info=True)
-        from fastapi.responses import JSONResponse
         return JSONResponse(
             status_code=500,
             content={"detail": f"Error acknowledging alert: {str(e)}"}
@@ -429,7 +431,6 @@ async def get_pulse_ox_data_endpoint(
 @app.get("/api/monitoring/alerts/{alert_id}/data")
 async def get_alert_data(alert_id: int):
     """Get detailed data for a specific alert event"""
-    from db import get_pulse_ox_data_for_alert
     
     try:
         data = get_pulse_ox_data_for_alert(alert_id)
@@ -1,8 +1,9 @@
 import json
+import math
 import os
 import paho.mqtt.client as mqtt
 from sensor_manager import SENSOR_DEFINITIONS
-from state_manager import get_websocket_clients, update_sensor, broadcast_state
+from state_manager import get_websocket_clients, update_sensor, broadcast_state, set_mqtt_connected
 from db import save_blood_pressure, save_temperature  # Add save_temperature import
 
 from dotenv import load_dotenv
@@ -20,13 +21,37 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 # Track latest sensor values, initialized as None
 sensor_state = {name: None for name in SENSOR_DEFINITIONS.keys()}
 
+# Reverse lookup so incoming messages don't scan SENSOR_DEFINITIONS
+TOPIC_TO_SENSOR = {topic: name for name, topic in SENSOR_DEFINITIONS.items()}
+
+def _as_number(value):
+    """Coerce a JSON reading to int/float, or None if it isn't a finite number."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    # json.loads and float() both accept NaN/Infinity, which would compare
+    # as out of range and raise a false alarm
+    if not math.isfinite(number):
+        return None
+    return int(number) if number.is_integer() else number
+
 def get_mqtt_client(loop):
     client = mqtt.Client(client_id=MQTT_CLIENT_ID)
 
     if MQTT_USERNAME and MQTT_PASSWORD:
         client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
+    # loop_forever reconnects on its own; keep the backoff short so
+    # publishing resumes quickly after a broker restart
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+
     def on_connect(client, userdata, flags, rc):
+        set_mqtt_connected(rc == 0)
         if rc == 0:
             print(f"Connected to MQTT Broker at {MQTT_BROKER}:{MQTT_PORT}")
             for topic in SENSOR_DEFINITIONS.values():
@@ -35,14 +60,17 @@ def get_mqtt_client(loop):
         else:
             print(f"Failed to connect to MQTT Broker, code {rc}")
 
+    def on_disconnect(client, userdata, rc):
+        set_mqtt_connected(False)
+        if rc != 0:
+            print(f"Disconnected from MQTT Broker unexpectedly, code {rc}")
+
     # Update the on_message function to save raw data
 
     def on_message(client, userdata, msg):
         raw_data = msg.payload.decode()
         print(f"MQTT Message received on {msg.topic}: {raw_data}")
-        matching_sensor = next(
-            (name for name, topic in SENSOR_DEFINITIONS.items() if topic == msg.topic), None
-        )
+        matching_sensor = TOPIC_TO_SENSOR.get(msg.topic)
 
         if matching_sensor:
             try:
@@ -83,18 +111,18 @@ def get_mqtt_client(loop):
                             body_temp=body_temp,
                             raw_data=raw_data
                         )
-                        # Update sensor values in state manager
-                        update_sensor(("skin_temp", skin_temp), from_mqtt=True)
-                        update_sensor(("body_temp", body_temp), from_mqtt=True)
-                        # Force a state broadcast to include the new temperature reading
+                        update_sensor((("skin_temp", skin_temp), ("body_temp", body_temp)), from_mqtt=True)
+                        # Force a state broadcast to include the new temperature
+                        # history, even if the values match the last reading
                         broadcast_state()
                     else:
                         print(f"Ignoring invalid temperature values: skin_temp={skin_temp}, body_temp={body_temp}")
                 
                 # Handle spo2 data specifically 
                 elif msg.topic == "shh/spo2/state" or msg.topic == "shh/bpm/state" or msg.topic == "shh/perfusion/state":
-                    # Add sensor update with raw data
-                    update_sensor(matching_sensor, payload.get(matching_sensor), "raw_data", raw_data)
+                    # Add sensor update with raw data; values are made numeric here
+                    # so state_manager can compare them directly
+                    update_sensor(matching_sensor, _as_number(payload.get(matching_sensor)), "raw_data", raw_data)
                     return
                 
                 # Continue with normal processing for other sensors
@@ -113,6 +141,7 @@ def get_mqtt_client(loop):
             print(f"Received message for unknown topic: {msg.topic}")
 
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
 
     return client
@@ -1,5 +1,7 @@
 import os
+import re
 import time
+import logging
 import serial
 from serial.tools import list_ports
 from dotenv import load_dotenv
@@ -8,9 +10,26 @@ from state_manager import update_sensor, set_serial_mode
 
 load_dotenv()
 
+logger = logging.getLogger('serial_reader')
+
 # Default Baud Rate (can override with .env)
 BAUD_RATE = int(os.getenv("BAUD_RATE", 19200))
 
+# One pulse-ox line: "<date> <time> <spo2>[*] <bpm>[*] <pa> [status]".
+# Non-numeric readings (e.g. "---" while the probe is off) leave the
+# numeric group empty rather than failing the whole line. Each numeric
+# group must take up its whole field, so "1.2abc" is not read as 1.2.
+LINE_RE = re.compile(
+    r'^(\S+\s+\S+)'
+    r'\s+(?:(\d+)\**(?=\s|$)|\S+)'
+    r'\s+(?:(\d+)\**(?=\s|$)|\S+)'
+    r'\s+(?:([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?=\s|$)|\S+)'
+    r'(?:\s+(\S+))?'
+)
+
+# Last port we successfully opened; retried first on reconnect
+_last_port = None
+
 def find_serial_port():
     """
     Scan connected serial ports for a known USB-Serial device.
@@ -30,17 +49,26 @@ def find_serial_port():
 def connect_serial():
     """
     Attempt to find and open the serial port. Retry every 5s if needed.
+    The last port that opened successfully is tried first.
     """
+    global _last_port
+
     while True:
-        port = find_serial_port()
+        # Try the last known-good port before rescanning all ports
+        port = _last_port or find_serial_port()
         if port:
             try:
                 ser = serial.Serial(port, BAUD_RATE, timeout=1, rtscts=False, dsrdtr=False)
                 print(f"[serial_reader] Connected to {port} @ {BAUD_RATE} baud")
+                _last_port = port
                 set_serial_mode(True)
                 return ser
             except Exception as e:
                 print(f"[serial_reader] Failed to open {port}: {e}")
+                if port == _last_port:
+                    # Forget it and fall back to a full scan right away
+                    _last_port = None
+                    continue
 
         set_serial_mode(False)
         print("[serial_reader] Retrying in 5s…")
@@ -56,43 +84,36 @@ def serial_loop():
             if not raw:
                 continue
 
-            parts = raw.split()
-            if len(parts) < 5:
-                print(f"[serial_reader] Skipping invalid line: {raw}")
+            match = LINE_RE.match(raw)
+            if not match:
+                logger.debug("Skipping invalid line: %s", raw)
                 continue
 
-            timestamp = f"{parts[0]} {parts[1]}"
-            spo2_str = parts[2].rstrip("*")
-            bpm_str = parts[3].rstrip("*")
-            pa_str = parts[4]
-            status = parts[5] if len(parts) > 5 else None
+            timestamp, spo2_str, bpm_str, pa_str, status = match.groups()
 
             updates = []
 
-            if spo2_str.isdigit():
+            if spo2_str:
                 updates.append(("spo2", int(spo2_str)))
 
-            if bpm_str.isdigit():
+            if bpm_str:
                 updates.append(("bpm", int(bpm_str)))
 
-            try:
-                perf = float(pa_str)
-                updates.append(("perfusion", perf))
-            except ValueError:
-                pass
+            if pa_str:
+                updates.append(("perfusion", float(pa_str)))
 
             if status:
                 updates.append(("status", status))
 
             if updates:
-                # Debug the updates being sent
-                print(f"[serial_reader] Sending updates: {updates}")
+                logger.debug("Sending updates: %s", updates)
                 
                 # Send the updates as a tuple rather than a list
                 # Lists aren't hashable but tuples are
                 update_sensor(tuple(updates), 'raw_data', raw)
 
-            print(f"[serial_reader] {timestamp} SpO2: {spo2_str}, BPM: {bpm_str}, Perfusion: {pa_str}, Status: {status}")
+            logger.debug("%s SpO2: %s, BPM: %s, Perfusion: %s, Status: %s",
+                         timestamp, spo2_str, bpm_str, pa_str, status)
 
         except serial.SerialException:
             print("[serial_reader] SerialException. Reconnecting…")
@@ -2,17 +2,66 @@
 
 import asyncio
 import json
+import logging
 from sensor_manager import SENSOR_DEFINITIONS
 import os
-from db import get_last_n_blood_pressure, get_last_n_temperature
+from db import (
+    BROADCAST_HISTORY_COUNT, get_last_n_blood_pressure, get_last_n_temperature, get_all_settings,
+    get_unacknowledged_alerts_count, queue_pulse_ox_data, save_pulse_ox_data_bulk,
+    start_monitoring_alert, update_monitoring_alert
+)
 from datetime import datetime
 import time
+import threading
 from collections import deque
+from starlette.websockets import WebSocketState
 
-MIN_SPO2 = int(os.getenv("MIN_SPO2", 90))
-MAX_SPO2 = int(os.getenv("MAX_SPO2", 100))
-MIN_BPM = int(os.getenv("MIN_BPM", 55))
-MAX_BPM = int(os.getenv("MAX_BPM", 155))
+logger = logging.getLogger('state_manager')
+
+# orjson is much faster than the stdlib encoder; fall back if it's missing
+try:
+    import orjson
+
+    def _dumps(obj):
+        """Serialize obj to JSON bytes."""
+        return orjson.dumps(obj, default=str)
+except ImportError:
+    def _dumps(obj):
+        """Serialize obj to JSON bytes."""
+        return json.dumps(obj, default=str).encode()
+
+# MQTT topic used by publish_to_mqtt
+MQTT_STATE_TOPIC = "medical/spo2/state"
+
+# Values from the last successful MQTT publish, used to skip repeats
+_last_mqtt_state = None
+
+# Per-sample publishes are not retained; the broker's retained copy is only
+# refreshed on an alarm change or every MQTT_RETAIN_INTERVAL seconds
+MQTT_RETAIN_INTERVAL = float(os.getenv("MQTT_RETAIN_INTERVAL", 5))
+_last_retained_ts = 0.0
+_last_retained_alarms = None
+_last_publish_retained = False
+_retain_refresh_pending = False
+_mqtt_lock = threading.Lock()
+
+# (epoch second, formatted string) for the MQTT payload timestamp
+_mqtt_ts_cache = (0, "")
+
+# Latest check_thresholds() result per signal, reused by publish_to_mqtt
+spo2_alarm_active = False
+hr_alarm_active = False
+
+# Sensor updates are coalesced so broadcast_state/publish_to_mqtt run at most
+# once per BROADCAST_INTERVAL seconds; the latest state always goes out
+BROADCAST_INTERVAL = float(os.getenv("BROADCAST_INTERVAL", 0.1))
+_broadcast_lock = threading.Lock()
+_broadcast_pending = False
+_last_broadcast_ts = 0.0
+
+# broadcast_state runs on the serial/MQTT threads, executor threads and API
+# requests; this keeps snapshot -> compare -> enqueue in order across them
+_broadcast_state_lock = threading.Lock()
 
 
 # -----------------------------------------------------------------------------
@@ -25,6 +74,21 @@ sensor_state = {name: None for name in SENSOR_DEFINITIONS.keys()}
 # Set of active WebSocket connections
 websocket_clients = set()
 
+# Immutable copy of websocket_clients for broadcasting, rebuilt on (un)register
+_clients_snapshot = ()
+
+# Per-client outbox: the newest payload not yet sent to that client and the
+# task sending it. Only touched on the event loop thread.
+_client_outbox = {}
+
+# State sent by the last broadcast; an identical state is not encoded or sent
+# again. Cleared when a client registers so the newcomer gets the next one.
+_last_broadcast_state = None
+
+# On Python 3.12+ drain tasks are started eagerly, so sends that fit in the
+# socket buffer finish without waiting for another loop iteration
+_eager_task_factory = getattr(asyncio, "eager_task_factory", None)
+
 # Flag: are we currently reading from serial (True) or from MQTT (False)?
 serial_active = False
 
@@ -32,22 +96,39 @@ serial_active = False
 mqtt_client = None
 event_loop = None
 
-_serial_mode_callbacks = []
+# Broker connection state, kept current by mqtt_handler's connect callbacks
+mqtt_connected = False
 
-from db import get_unacknowledged_alerts_count, save_pulse_ox_data, start_monitoring_alert, update_monitoring_alert
+_serial_mode_callbacks = []
 
 # Add these global variables to track the current alert state
 current_alert_id = None
 alert_thresholds_exceeded = False
 alert_start_data_id = None
 
+# Consecutive out-of-range samples required before an alert starts. Runs are
+# counted per signal and only reset by an in-range reading of that signal, as
+# MQTT delivers spo2 and bpm in separate messages.
+ALERT_MIN_BREACHES = int(os.getenv("ALERT_MIN_BREACHES", 1))
+_spo2_breach_run = 0
+_hr_breach_run = 0
+
+# [spo2_min, spo2_max, bpm_min, bpm_max] and triggered flags of the current
+# alert, so the alert row is only rewritten when something actually changes
+_alert_extremes = None
+_alert_triggered = None
+
 # Add these global variables to track recovery timing
-alert_recovery_start_time = None
+alert_recovery_start_time = None  # time.monotonic() of the first good reading
 RECOVERY_SECONDS_REQUIRED = 30  # Require 30 seconds of good readings to end an alert
 
 # Add these global variables for caching pulse ox data
 pulse_ox_cache = deque(maxlen=150)  # ~30 seconds at 5Hz sample rate
-event_data_points = []  # Store all data points during an event
+# Every point is already queued to pulse_ox_data with its db_id, so only the
+# most recent points of the current event are kept in memory
+EVENT_MAX_POINTS = 300  # ~60 seconds at 5Hz
+event_data_points = deque(maxlen=EVENT_MAX_POINTS)  # Data points for the current event
+event_point_count = 0  # Points in the current event, including trimmed ones
 CACHE_DURATION_SECONDS = 30  # How many seconds of data to keep in normal operation
 
 
@@ -55,18 +136,6 @@ def register_serial_mode_callback(cb):
     """Call `cb(serial_active: bool)` whenever serial_active flips."""
     _serial_mode_callbacks.append(cb)
 
-def set_serial_mode(active: bool):
-    global serial_active
-    if serial_active == active:
-        return
-    serial_active = active
-    # Notify everyone
-    for cb in _serial_mode_callbacks:
-        try:
-            cb(active)
-        except:
-            pass
-
 # -----------------------------------------------------------------------------
 # Initialization hooks (call at startup)
 # -----------------------------------------------------------------------------
@@ -83,16 +152,37 @@ def set_mqtt_client(client):
     mqtt_client = client
 
 
+def set_mqtt_connected(connected: bool):
+    """Record whether the MQTT client is connected to the broker."""
+    global mqtt_connected, _last_mqtt_state, _last_retained_alarms, _last_publish_retained
+    with _mqtt_lock:
+        mqtt_connected = connected
+        if connected:
+            # The broker may not have kept our retained state, so publish
+            # the current values again as a fresh retained message
+            _last_mqtt_state = None
+            _last_retained_alarms = None
+            _last_publish_retained = False
+    if connected:
+        publish_to_mqtt()
+
+
 # -----------------------------------------------------------------------------
 # WebSocket client management (used by your FastAPI ws endpoint)
 # -----------------------------------------------------------------------------
 
 def register_websocket_client(ws):
+    global _clients_snapshot, _last_broadcast_state
     websocket_clients.add(ws)
+    _clients_snapshot = tuple(websocket_clients)
+    _last_broadcast_state = None
 
 
 def unregister_websocket_client(ws):
+    global _clients_snapshot
     websocket_clients.discard(ws)
+    _clients_snapshot = tuple(websocket_clients)
+    _client_outbox.pop(ws, None)
 
 
 # -----------------------------------------------------------------------------
@@ -102,7 +192,17 @@ def unregister_websocket_client(ws):
 def set_serial_mode(active: bool):
     """Flip between serial (True) and MQTT (False) input modes."""
     global serial_active
+    if serial_active == active:
+        return
     serial_active = active
+    if not _serial_mode_callbacks:
+        return
+    # Notify everyone
+    for cb in _serial_mode_callbacks:
+        try:
+            cb(active)
+        except Exception as e:
+            logger.error("Serial mode callback failed: %s", e)
 
 
 def is_serial_mode() -> bool:
@@ -113,53 +213,76 @@ def is_serial_mode() -> bool:
 # Core update / broadcast logic
 # -----------------------------------------------------------------------------
 
+def _mqtt_timestamp():
+    """Return the MQTT payload timestamp, formatted at most once per second."""
+    global _mqtt_ts_cache
+    now = time.time()
+    sec = int(now)
+    if sec != _mqtt_ts_cache[0]:
+        _mqtt_ts_cache = (sec, datetime.fromtimestamp(sec).strftime("%y-%b-%d %H:%M:%S"))
+    return _mqtt_ts_cache[1]
+
+
 def publish_to_mqtt():
     """
     Publish current sensor state to Home Assistant MQTT topics
     following the format of the original script.
+    
+    Publishing is skipped when the values are unchanged since the last
+    successful publish. Only alarm transitions and a periodic snapshot are
+    published retained, so the broker isn't rewriting its retained store
+    on every sample. After an unretained publish a refresh is scheduled so
+    the retained copy catches up even if the values then stop changing.
     """
+    with _mqtt_lock:
+        _publish_state()
+
+
+def _publish_state():
+    global _last_mqtt_state, _last_retained_ts, _last_retained_alarms
+    global _last_publish_retained, _retain_refresh_pending
+    
     if not mqtt_client:
-        print("[state_manager] Cannot publish to MQTT, mqtt_client not set.")
+        logger.debug("Cannot publish to MQTT, mqtt_client not set.")
         return
     
-    # Check if MQTT client is connected
-    try:
-        if not mqtt_client.is_connected():
-            print("[state_manager] MQTT client is not connected. Attempting to reconnect...")
-            mqtt_client.reconnect()
-    except Exception as e:
-        print(f"[state_manager] Error checking MQTT connection: {e}")
+    # Reconnecting is left to the client's network loop thread; a blocking
+    # reconnect() here would stall every sensor update while the broker is down
+    if not mqtt_connected:
         return
     
-    # Use medical-test prefix for testing
-    base_topic = "medical/spo2/state"
-    
+    # Read each value once; .get() so a sensor missing from
+    # SENSOR_DEFINITIONS publishes as None instead of raising
+    spo2 = sensor_state.get("spo2")
+    bpm = sensor_state.get("bpm")
+    perfusion = sensor_state.get("perfusion")
+    status = sensor_state.get("status")
+
     # Status to motion conversion
-    if sensor_state["status"] is None:
-        motion = "OFF"
-    else:
-        motion = "ON" if "MO" in sensor_state["status"] else "OFF"
+    motion = "ON" if status is not None and "MO" in status else "OFF"
 
-    # Alarm Logic
-    if sensor_state["spo2"] is None:
-        spo2_alarm = "OFF"
-    else:
-        spo2_alarm = "ON" if not (MIN_SPO2 <= int(sensor_state["spo2"]) <= MAX_SPO2) else "OFF"
+    # Alarm flags were already computed by check_thresholds in update_sensor
+    spo2_alarm = "ON" if spo2_alarm_active else "OFF"
+    hr_alarm = "ON" if hr_alarm_active else "OFF"
 
-    if sensor_state["bpm"] is None:
-        hr_alarm = "OFF"
-    else:
-        hr_alarm = "ON" if not (MIN_BPM <= int(sensor_state["bpm"]) <= MAX_BPM) else "OFF"
+    now = time.monotonic()
+    alarms = (spo2_alarm, hr_alarm)
+    retain = alarms != _last_retained_alarms or now - _last_retained_ts >= MQTT_RETAIN_INTERVAL
+
+    # An unchanged state is only sent again to refresh a stale retained copy
+    state_key = (spo2, bpm, perfusion, status, motion, spo2_alarm, hr_alarm)
+    if state_key == _last_mqtt_state and (_last_publish_retained or not retain):
+        return
 
     # Create payload matching the original script format
-    timestamp = datetime.now().strftime("%y-%b-%d %H:%M:%S")
+    timestamp = _mqtt_timestamp()
     
     payload = {
         "timestamp": timestamp,
-        "spo2": sensor_state["spo2"],
-        "bpm": sensor_state["bpm"],
-        "pa": sensor_state["perfusion"],
-        "status": sensor_state["status"],
+        "spo2": spo2,
+        "bpm": bpm,
+        "pa": perfusion,
+        "status": status,
         "motion": motion,
         "spo2_alarm": spo2_alarm,
         "hr_alarm": hr_alarm
@@ -167,19 +290,57 @@ def publish_to_mqtt():
 
     # Send to test topic with better error handling
     try:
-        json_payload = json.dumps(payload)
-        result = mqtt_client.publish(base_topic, json_payload, retain=True)
+        json_payload = _dumps(payload)
+        result = mqtt_client.publish(MQTT_STATE_TOPIC, json_payload, retain=retain)
         
         # Check the result
         if result.rc == 0:
-            print(f"[state_manager] Published to {base_topic}: {json_payload}")
+            _last_mqtt_state = state_key
+            _last_publish_retained = retain
+            if retain:
+                _last_retained_ts = now
+                _last_retained_alarms = alarms
+            elif event_loop and not _retain_refresh_pending:
+                _retain_refresh_pending = True
+                delay = MQTT_RETAIN_INTERVAL - (now - _last_retained_ts)
+                event_loop.call_soon_threadsafe(event_loop.call_later, delay, _refresh_retained)
+            logger.debug("Published to %s: %s", MQTT_STATE_TOPIC, json_payload)
         else:
-            print(f"[state_manager] Failed to publish to {base_topic}, result code: {result.rc}")
-            
-        # Also publish availability
-        mqtt_client.publish("medical-test/spo2/availability", "online", retain=True)
+            logger.warning("Failed to publish to %s, result code: %s", MQTT_STATE_TOPIC, result.rc)
     except Exception as e:
-        print(f"[state_manager] Error publishing to MQTT: {e}")
+        logger.error("Error publishing to MQTT: %s", e)
+
+
+def _refresh_retained():
+    """Runs on the event loop once a retained snapshot is due."""
+    global _retain_refresh_pending
+    _retain_refresh_pending = False
+    publish_to_mqtt()
+
+
+# (settings dict, (min_spo2, max_spo2, min_bpm, max_bpm)) last parsed
+_thresholds = None
+
+
+def _get_thresholds():
+    """
+    Return the alarm thresholds from settings. get_all_settings() is cached
+    and hands back the same dict until a setting is written, so the values
+    are only re-parsed after a settings change.
+    """
+    global _thresholds
+    settings = get_all_settings()
+    if _thresholds is None or _thresholds[0] is not settings:
+        def setting(key, default):
+            entry = settings.get(key)
+            return int(entry['value']) if entry else default
+        _thresholds = (settings, (
+            setting('min_spo2', 90),
+            setting('max_spo2', 100),
+            setting('min_bpm', 55),
+            setting('max_bpm', 155),
+        ))
+    return _thresholds[1]
 
 
 def check_thresholds(spo2, bpm):
@@ -188,95 +349,232 @@ def check_thresholds(spo2, bpm):
     Returns:
         tuple: (spo2_alarm, hr_alarm) boolean flags
     """
-    from db import get_setting
-    
-    # Get threshold settings, ensuring they're integers
-    min_spo2 = int(get_setting('min_spo2', 90))
-    max_spo2 = int(get_setting('max_spo2', 100))
-    min_bpm = int(get_setting('min_bpm', 55))
-    max_bpm = int(get_setting('max_bpm', 155))
-    
-    spo2_alarm = False
-    hr_alarm = False
-    
-    # Only check if we have valid data
-    if spo2 is not None:
-        # Make sure spo2 is an integer for comparison
-        if isinstance(spo2, str) and spo2.isdigit():
-            spo2 = int(spo2)
-        
-        if isinstance(spo2, (int, float)):
-            spo2_alarm = spo2 < min_spo2 or spo2 > max_spo2
+    min_spo2, max_spo2, min_bpm, max_bpm = _get_thresholds()
     
-    if bpm is not None:
-        # Make sure bpm is an integer for comparison
-        if isinstance(bpm, str) and bpm.isdigit():
-            bpm = int(bpm)
-            
-        if isinstance(bpm, (int, float)):
-            hr_alarm = bpm < min_bpm or bpm > max_bpm
+    # Readings are numeric or None by the time they get here: serial_reader
+    # parses them and mqtt_handler coerces them on receipt
+    spo2_alarm = spo2 is not None and not (min_spo2 <= spo2 <= max_spo2)
+    hr_alarm = bpm is not None and not (min_bpm <= bpm <= max_bpm)
     
     if spo2_alarm or hr_alarm:
-        print(f"[state_manager] ALERT! SpO2: {spo2} (threshold: {min_spo2}-{max_spo2}), "
-              f"HR: {bpm} (threshold: {min_bpm}-{max_bpm})")
+        logger.debug("ALERT! SpO2: %s (threshold: %s-%s), HR: %s (threshold: %s-%s)",
+                     spo2, min_spo2, max_spo2, bpm, min_bpm, max_bpm)
     
     return spo2_alarm, hr_alarm
 
 
+def _queue_payload(payload):
+    """
+    Put the newest payload in every client's outbox and start a sender for
+    clients that are idle (loop thread only). Each client drains on its own,
+    so one slow socket doesn't hold back the others.
+    """
+    for ws in _clients_snapshot:
+        # Sockets already closed from either side are dropped without a send attempt
+        if WebSocketState.DISCONNECTED in (ws.client_state, ws.application_state):
+            unregister_websocket_client(ws)
+            continue
+        
+        outbox = _client_outbox.setdefault(ws, {'payload': None, 'task': None})
+        outbox['payload'] = payload
+        if outbox['task'] is None:
+            if _eager_task_factory:
+                task = _eager_task_factory(event_loop, _drain_client(ws, outbox))
+            else:
+                task = event_loop.create_task(_drain_client(ws, outbox))
+            # An eagerly started task may have finished already
+            outbox['task'] = None if task.done() else task
+
+
+async def _drain_client(ws, outbox):
+    """
+    Send a client's outbox until it is empty. A payload replaced while the
+    previous send was still in flight is never sent, so a slow client
+    can't build up a backlog of stale states.
+    """
+    try:
+        while outbox['payload'] is not None:
+            payload, outbox['payload'] = outbox['payload'], None
+            await ws.send_text(payload)
+    except Exception as e:
+        logger.warning("Failed to send to websocket: %s", e)
+        unregister_websocket_client(ws)
+    finally:
+        outbox['task'] = None
+
+
 def broadcast_state():
     """
     Send the full `sensor_state` snapshot over WebSockets to all clients.
     Include alert counts, BP readings, temperature readings, and settings.
     """
+    global _last_broadcast_state
+    
     if not event_loop:
-        print("[state_manager] Cannot broadcast, event_loop not set.")
+        logger.debug("Cannot broadcast, event_loop not set.")
+        return
+    
+    # Nobody is listening, so skip the DB reads and serialization entirely
+    clients = _clients_snapshot
+    if not clients:
         return
 
-    # Get the last 5 blood pressure readings
-    bp_history = get_last_n_blood_pressure(5)
+    # Held from the reads through call_soon_threadsafe so an older snapshot
+    # can never be queued after a newer one
+    with _broadcast_state_lock:
+        # Get the last 5 blood pressure readings
+        bp_history = get_last_n_blood_pressure(BROADCAST_HISTORY_COUNT)
     
-    # Get the last 5 temperature readings
-    temp_history = get_last_n_temperature(5)
+        # Get the last 5 temperature readings
+        temp_history = get_last_n_temperature(BROADCAST_HISTORY_COUNT)
     
-    # Get all settings
-    from db import get_all_settings, get_unacknowledged_alerts_count
-    settings = get_all_settings()
+        # Get all settings
+        settings = get_all_settings()
     
-    # Get unacknowledged alerts count
-    alerts_count = get_unacknowledged_alerts_count()
-    
-    # Create a clean copy of the current state with only proper keys
-    state_copy = {}
-    for key, value in sensor_state.items():
-        # Only include string keys that are actual sensor names (not tuples)
-        if isinstance(key, str):
-            state_copy[key] = value
-    
-    # Add histories and other data
-    state_copy['bp'] = bp_history
-    state_copy['temp'] = temp_history
-    state_copy['settings'] = settings
-    state_copy['alerts_count'] = alerts_count
-    
-    # Ensure all standard values have defaults
-    for key in ['spo2', 'bpm', 'perfusion', 'status', 'map_bp']:
-        if key not in state_copy or state_copy[key] is None:
-            state_copy[key] = -1  # Use -1 as sentinel value
-    
-    print(f"[state_manager] Clean state to broadcast: {state_copy}")
-    
-    print(f"[state_manager] Broadcasting to {len(websocket_clients)} clients.")
-    message = {
-        "type": "sensor_update",
-        "state": state_copy
-    }
+        # Get unacknowledged alerts count
+        alerts_count = get_unacknowledged_alerts_count()
+    
+        # update_sensor only ever stores string keys, so a plain copy is clean
+        state_copy = dict(sensor_state)
+    
+        # Add histories and other data
+        state_copy['bp'] = bp_history
+        state_copy['temp'] = temp_history
+        state_copy['settings'] = settings
+        state_copy['alerts_count'] = alerts_count
+    
+        # Nothing changed since the last broadcast (the cached histories and
+        # settings compare by identity first, so this is cheap)
+        if state_copy == _last_broadcast_state:
+            return
+        _last_broadcast_state = state_copy
+    
+        logger.debug("Clean state to broadcast: %s", state_copy)
+    
+        logger.debug("Broadcasting to %d clients.", len(clients))
+        message = {
+            "type": "sensor_update",
+            "state": state_copy
+        }
+    
+        # Serialize once for all clients; sent as a text frame because the
+        # dashboard parses event.data with JSON.parse
+        payload = _dumps(message).decode()
+    
+        # One hop onto the event loop; the sends then run concurrently there
+        event_loop.call_soon_threadsafe(_queue_payload, payload)
+
+
+def _flush_broadcast():
+    """Push the current state to WebSocket clients and MQTT."""
+    global _broadcast_pending, _last_broadcast_ts
+    with _broadcast_lock:
+        _broadcast_pending = False
+        _last_broadcast_ts = time.monotonic()
+    # Deferred flushes run in the executor, where an exception would only
+    # surface as an unretrieved future; log it and still publish to MQTT
+    try:
+        broadcast_state()
+    except Exception:
+        logger.exception("Error broadcasting state")
+    try:
+        publish_to_mqtt()
+    except Exception:
+        logger.exception("Error publishing state to MQTT")
+
+
+def _deferred_flush():
+    # Runs on the event loop; keep the DB reads in broadcast_state off it
+    event_loop.run_in_executor(None, _flush_broadcast)
+
+
+def schedule_broadcast(immediate=False):
+    """
+    Broadcast the current state now, or once BROADCAST_INTERVAL has passed
+    since the last broadcast. Updates arriving in between are merged into
+    that single trailing broadcast.
+    """
+    global _broadcast_pending
+    with _broadcast_lock:
+        if _broadcast_pending and not immediate:
+            return
+        delay = BROADCAST_INTERVAL - (time.monotonic() - _last_broadcast_ts)
+        if immediate or delay <= 0 or not event_loop:
+            flush_now = True
+        else:
+            flush_now = False
+            _broadcast_pending = True
     
-    for ws in list(websocket_clients):
+    if flush_now:
+        _flush_broadcast()
+    else:
+        event_loop.call_soon_threadsafe(event_loop.call_later, delay, _deferred_flush)
+
+
+# Keys that make up a pulse-ox reading
+_PULSE_KEYS = frozenset(('spo2', 'bpm', 'perfusion', 'status'))
+
+
+def _alert_changed_by(spo2, bpm, spo2_alarm=False, hr_alarm=False):
+    """
+    Fold a sample into the current alert's extremes and triggered flags.
+    Returns True if the alert row needs an update.
+    """
+    changed = False
+    for i, value in ((0, spo2), (2, bpm)):
+        if value is None:
+            continue
         try:
-            asyncio.run_coroutine_threadsafe(ws.send_json(message), event_loop)
-        except Exception as e:
-            print(f"[state_manager] Failed to send to websocket: {e}")
-            websocket_clients.discard(ws)
+            if _alert_extremes[i] is None or value < _alert_extremes[i]:
+                _alert_extremes[i] = value
+                changed = True
+            if _alert_extremes[i + 1] is None or value > _alert_extremes[i + 1]:
+                _alert_extremes[i + 1] = value
+                changed = True
+        except TypeError:
+            # Non-numeric reading; let update_monitoring_alert decide
+            changed = True
+    for i, alarm in ((0, spo2_alarm), (1, hr_alarm)):
+        if alarm and not _alert_triggered[i]:
+            _alert_triggered[i] = True
+            changed = True
+    return changed
+
+
+def _normalize_updates(updates):
+    """
+    Reduce the argument shapes update_sensor accepts to (pairs, raw_data).
+    
+    Accepted shapes:
+        ((name, value), ...), 'raw_data', raw   -- serial_reader
+        (name, value)                           -- a single pair
+        [(name, value), ...]                    -- a list/tuple of pairs
+        name, value, name, value, ...           -- flat positional pairs
+    
+    A "raw_data" entry among the pairs is returned separately; pairs with a
+    non-string name are dropped so they never become sensor_state keys.
+    """
+    raw_data = None
+    if len(updates) >= 3 and updates[1] == 'raw_data' and isinstance(updates[0], (list, tuple)):
+        items = updates[0]
+        raw_data = updates[2]
+    elif len(updates) == 1 and isinstance(updates[0], tuple) and len(updates[0]) == 2 and isinstance(updates[0][0], str):
+        items = (updates[0],)
+    elif len(updates) == 1 and isinstance(updates[0], (list, tuple)) and all(isinstance(x, tuple) for x in updates[0]):
+        items = updates[0]
+    else:
+        items = zip(updates[0::2], updates[1::2])
+    
+    pairs = []
+    for name, value in items:
+        if name == "raw_data":
+            if raw_data is None:
+                raw_data = value
+        elif isinstance(name, str):
+            pairs.append((name, value))
+        else:
+            logger.warning("Ignoring invalid sensor name: %r", name)
+    return pairs, raw_data
 
 
 # Update the update_sensor function to handle input from serial_reader correctly
@@ -285,123 +583,100 @@ def update_sensor(*updates, from_mqtt=False):
     """
     Update sensor state values, track alerts, and broadcast changes
     
+    All values passed in one call are applied together and broadcast once,
+    so callers with several readings should batch them into a single call.
+    
     Args:
-        *updates: Either pairs of (sensor_name, value) or a list of (name, value) tuples
+        *updates: Any argument shape accepted by _normalize_updates
         from_mqtt: Whether this update is from MQTT (vs serial)
     """
     global current_alert_id, alert_thresholds_exceeded, alert_start_data_id, sensor_state
-    global alert_recovery_start_time, pulse_ox_cache, event_data_points
+    global alert_recovery_start_time, pulse_ox_cache, event_data_points, event_point_count
+    global spo2_alarm_active, hr_alarm_active
+    global _spo2_breach_run, _hr_breach_run, _alert_extremes, _alert_triggered
     
     has_pulse_ox_updates = False
-    pulse_ox_data = {
-        'spo2': None,
-        'bpm': None,
-        'perfusion': None,
-        'status': None
-    }
+    spo2 = bpm = perfusion = status = None
     
     updated = {}  # Track what's been updated for MQTT publishing
-    raw_data = None
-    current_time = datetime.now().isoformat()
+    changed = False  # Whether any value differs from the current state
+    alert_changed = False  # Alert start/end is broadcast without throttling
     
     # Debug the incoming updates to see what we're getting
-    print(f"[state_manager] Received updates: {updates}")
-    
-    # Handle the way serial_reader.py is calling this function
-    # It sends: ([('spo2', 99), ('bpm', 91), ('perfusion', 4.0)], 'raw_data', '25-Jul-06 21:15:30    99      91       4')
-    if len(updates) >= 3 and updates[1] == 'raw_data' and isinstance(updates[0], (list, tuple)):
-        pairs = updates[0]
-        raw_data = updates[2]
-        
-        for name, value in pairs:
-            if name != "raw_data":
-                sensor_state[name] = value  # Direct assignment with name as key
-                updated[name] = value
-                
-                if name in pulse_ox_data:
-                    pulse_ox_data[name] = value
-                    has_pulse_ox_updates = True
-    
-    # Process updates based on how they're passed - keep existing handlers too
-    elif len(updates) == 1 and isinstance(updates[0], (list, tuple)) and all(isinstance(x, tuple) for x in updates[0]):
-        # Handle case where a list/tuple of (name, value) pairs is passed
-        pairs = updates[0]
+    logger.debug("Received updates: %s", updates)
+    
+    pairs, raw_data = _normalize_updates(updates)
+    for name, value in pairs:
+        if name not in sensor_state or sensor_state[name] != value:
+            sensor_state[name] = value
+            changed = True
+        updated[name] = value
         
-        # Look for raw_data separately
-        raw_data_items = [pair[1] for pair in pairs if pair[0] == "raw_data"]
-        if raw_data_items:
-            raw_data = raw_data_items[0]
-            
-        # Process normal sensor values
-        for name, value in pairs:
-            if name != "raw_data":
-                sensor_state[name] = value  # Direct assignment with name as key
-                updated[name] = value
-                
-                if name in pulse_ox_data:
-                    pulse_ox_data[name] = value
-                    has_pulse_ox_updates = True
-    else:
-        # Handle case where name, value are passed as separate arguments
-        for i in range(0, len(updates), 2):
-            if i+1 < len(updates):  # Make sure we have a pair
-                sensor_name = updates[i]
-                value = updates[i+1]
-                
-                if sensor_name == "raw_data":
-                    raw_data = value
-                    continue
-                    
-                # Direct assignment with name as key
-                sensor_state[sensor_name] = value  
-                updated[sensor_name] = value
-                
-                # Track pulse ox related updates
-                if sensor_name in pulse_ox_data:
-                    pulse_ox_data[sensor_name] = value
-                    has_pulse_ox_updates = True
+        # Track pulse ox related updates
+        if name in _PULSE_KEYS:
+            has_pulse_ox_updates = True
+            if name == 'spo2':
+                spo2 = value
+            elif name == 'bpm':
+                bpm = value
+            elif name == 'perfusion':
+                perfusion = value
+            else:
+                status = value
     
-    # Print current state for debugging (after fixing it)
-    print(f"[state_manager] Current sensor state after update: {sensor_state}")
+    # Log current state for debugging (after fixing it)
+    logger.debug("Current sensor state after update: %s", sensor_state)
     
     # If no updates, exit early
     if not updated:
-        print("[state_manager] No updates to process")
+        logger.debug("No updates to process")
         return
 
     # If we received pulse ox data, cache it and check for alerts
-    if has_pulse_ox_updates and (pulse_ox_data['spo2'] is not None or pulse_ox_data['bpm'] is not None):
+    if has_pulse_ox_updates and (spo2 is not None or bpm is not None):
+        # One timestamp for the cached point, the DB row and alert logging
+        current_time = datetime.now().isoformat()
+        
+        # Check if values exceed thresholds
+        spo2_alarm, hr_alarm = check_thresholds(spo2, bpm)
+        motion_str = "ON" if sensor_state.get("motion", False) else "OFF"
+        spo2_alarm_str = "ON" if spo2_alarm else "OFF"
+        hr_alarm_str = "ON" if hr_alarm else "OFF"
+        
         # Cache the current pulse ox data point
         data_point = {
             'timestamp': current_time,
-            'spo2': pulse_ox_data['spo2'],
-            'bpm': pulse_ox_data['bpm'],
-            'perfusion': pulse_ox_data['perfusion'],
-            'status': pulse_ox_data['status'],
-            'motion': "ON" if sensor_state.get("motion", False) else "OFF",
-            'raw_data': raw_data
+            'spo2': spo2,
+            'bpm': bpm,
+            'perfusion': perfusion,
+            'status': status,
+            'motion': motion_str,
+            'raw_data': raw_data,
+            'spo2_alarm': spo2_alarm_str,
+            'hr_alarm': hr_alarm_str
         }
         
         # Always add to the rolling cache
         pulse_ox_cache.append(data_point)
         
-        # Check if values exceed thresholds
-        spo2_alarm, hr_alarm = check_thresholds(pulse_ox_data['spo2'], pulse_ox_data['bpm'])
-        
-        # Add alarm status to the data point
-        data_point['spo2_alarm'] = "ON" if spo2_alarm else "OFF"
-        data_point['hr_alarm'] = "ON" if hr_alarm else "OFF"
+        # Remember the result for MQTT; a signal missing from this update
+        # keeps its previous alarm state
+        if spo2 is not None:
+            spo2_alarm_active = spo2_alarm
+        if bpm is not None:
+            hr_alarm_active = hr_alarm
         
-        # Save data to the continuous log
-        data_id = save_pulse_ox_data(
-            spo2=pulse_ox_data['spo2'], 
-            bpm=pulse_ox_data['bpm'],
-            pa=pulse_ox_data['perfusion'],
-            status=pulse_ox_data['status'],
-            motion="ON" if sensor_state.get("motion", False) else "OFF",
-            spo2_alarm="ON" if spo2_alarm else "OFF",
-            hr_alarm="ON" if hr_alarm else "OFF",
-            raw_data=json.dumps(pulse_ox_data)
+        # Queue data for the continuous log; the id is assigned immediately
+        data_id = queue_pulse_ox_data(
+            spo2=spo2, 
+            bpm=bpm,
+            pa=perfusion,
+            status=status,
+            motion=motion_str,
+            spo2_alarm=spo2_alarm_str,
+            hr_alarm=hr_alarm_str,
+            raw_data=raw_data,
+            timestamp=current_time
         )
         
         # Update the data point with the DB ID
@@ -409,25 +684,36 @@ def update_sensor(*updates, from_mqtt=False):
         
         # Check if we need to start or update an alert
         is_alert_condition = spo2_alarm or hr_alarm
+        if spo2 is not None:
+            _spo2_breach_run = _spo2_breach_run + 1 if spo2_alarm else 0
+        if bpm is not None:
+            _hr_breach_run = _hr_breach_run + 1 if hr_alarm else 0
+        breach_confirmed = ((spo2_alarm and _spo2_breach_run >= ALERT_MIN_BREACHES) or
+                            (hr_alarm and _hr_breach_run >= ALERT_MIN_BREACHES))
         
-        if is_alert_condition and not alert_thresholds_exceeded:
+        if breach_confirmed and not alert_thresholds_exceeded:
             # We've just crossed the threshold, start a new alert
             alert_thresholds_exceeded = True
             alert_recovery_start_time = None  # Reset recovery timer
             alert_start_data_id = data_id
             
             # Clear the event data points and add all cached points from before the event
-            event_data_points = list(pulse_ox_cache)
-            print(f"[state_manager] Alert started. Including {len(event_data_points)} cached data points.")
+            event_data_points = deque(pulse_ox_cache, maxlen=EVENT_MAX_POINTS)
+            event_point_count = len(event_data_points)
+            alert_changed = True
+            logger.info("Alert started. Including %d cached data points.", len(event_data_points))
             
             # Start a new monitoring alert
             current_alert_id = start_monitoring_alert(
-                spo2=pulse_ox_data['spo2'],
-                bpm=pulse_ox_data['bpm'],
+                spo2=spo2,
+                bpm=bpm,
                 data_id=data_id,
                 spo2_alarm_triggered=1 if spo2_alarm else 0,
                 hr_alarm_triggered=1 if hr_alarm else 0
             )
+            _alert_extremes = [spo2, spo2,
+                               bpm, bpm]
+            _alert_triggered = [bool(spo2_alarm), bool(hr_alarm)]
             
         elif is_alert_condition and alert_thresholds_exceeded and current_alert_id:
             # Continuing alert, update min/max values
@@ -435,49 +721,50 @@ def update_sensor(*updates, from_mqtt=False):
             
             # Add this data point to our event collection
             event_data_points.append(data_point)
+            event_point_count += 1
             
-            update_monitoring_alert(
-                alert_id=current_alert_id,
-                spo2=pulse_ox_data['spo2'],
-                bpm=pulse_ox_data['bpm'],
-                spo2_alarm_triggered=1 if spo2_alarm else None,
-                hr_alarm_triggered=1 if hr_alarm else None
-            )
+            if _alert_changed_by(spo2, bpm, spo2_alarm, hr_alarm):
+                update_monitoring_alert(
+                    alert_id=current_alert_id,
+                    spo2=spo2,
+                    bpm=bpm,
+                    spo2_alarm_triggered=1 if spo2_alarm else None,
+                    hr_alarm_triggered=1 if hr_alarm else None
+                )
             
         elif not is_alert_condition and alert_thresholds_exceeded and current_alert_id:
             # Values are now within normal range, but we're still in an alert state
             # Start or continue tracking recovery time
-            current_time_obj = datetime.now()
-            
             # Add this data point to our event collection
             event_data_points.append(data_point)
+            event_point_count += 1
             
             if alert_recovery_start_time is None:
                 # First good reading after an alert, start recovery timer
-                alert_recovery_start_time = time.time()
-                print(f"[state_manager] Alert recovery started at {datetime.fromtimestamp(alert_recovery_start_time).isoformat()}")
+                alert_recovery_start_time = time.monotonic()
+                logger.info("Alert recovery started at %s", current_time)
                 
                 # Still update the min/max values during recovery period
-                update_monitoring_alert(
-                    alert_id=current_alert_id,
-                    spo2=pulse_ox_data['spo2'],
-                    bpm=pulse_ox_data['bpm']
-                )
-            elif (time.time() - alert_recovery_start_time) >= RECOVERY_SECONDS_REQUIRED:
+                if _alert_changed_by(spo2, bpm):
+                    update_monitoring_alert(
+                        alert_id=current_alert_id,
+                        spo2=spo2,
+                        bpm=bpm
+                    )
+            elif (elapsed := time.monotonic() - alert_recovery_start_time) >= RECOVERY_SECONDS_REQUIRED:
                 # We've had good readings for the required duration, finalize the alert
-                now = current_time_obj.isoformat()
-                print(f"[state_manager] Alert recovery completed after {RECOVERY_SECONDS_REQUIRED} seconds at {now}")
+                now = current_time
+                logger.info("Alert recovery completed after %s seconds at %s", RECOVERY_SECONDS_REQUIRED, now)
                 
                 update_monitoring_alert(
                     alert_id=current_alert_id,
                     end_time=now,
                     end_data_id=data_id,
-                    spo2=pulse_ox_data['spo2'],
-                    bpm=pulse_ox_data['bpm']
+                    spo2=spo2,
+                    bpm=bpm
                 )
                 
-                # Alert has ended, collect event data
-                print(f"[state_manager] Alert ended. Collecting {len(event_data_points)} data points for the event.")
+                logger.info("Alert ended after %d data points.", event_point_count)
                 
                 # Add the event data to the alert record in DB
                 store_event_data_for_alert(current_alert_id, event_data_points)
@@ -486,25 +773,26 @@ def update_sensor(*updates, from_mqtt=False):
                 alert_thresholds_exceeded = False
                 current_alert_id = None
                 alert_recovery_start_time = None
-                event_data_points = []
+                event_data_points = deque(maxlen=EVENT_MAX_POINTS)
+                event_point_count = 0
+                alert_changed = True
             else:
                 # Still in recovery period, update the alert but don't end it yet
-                elapsed = time.time() - alert_recovery_start_time
                 remaining = RECOVERY_SECONDS_REQUIRED - elapsed
-                print(f"[state_manager] Alert recovery in progress: {elapsed:.1f}s elapsed, {remaining:.1f}s remaining")
+                logger.debug("Alert recovery in progress: %.1fs elapsed, %.1fs remaining", elapsed, remaining)
                 
                 # Update min/max values during recovery period
-                update_monitoring_alert(
-                    alert_id=current_alert_id,
-                    spo2=pulse_ox_data['spo2'],
-                    bpm=pulse_ox_data['bpm']
-                )
-    
-    # Broadcast updated state
-    broadcast_state()
+                if _alert_changed_by(spo2, bpm):
+                    update_monitoring_alert(
+                        alert_id=current_alert_id,
+                        spo2=spo2,
+                        bpm=bpm
+                    )
     
-    # Publish to MQTT if needed
-    publish_to_mqtt()
+    # Broadcast updated state and publish to MQTT (coalesced); repeated
+    # readings are still recorded above but there is nothing new to send
+    if changed or alert_changed:
+        schedule_broadcast(immediate=alert_changed)
 
 
 # Add this function to expose the websocket clients to other modules
@@ -539,29 +827,15 @@ def store_event_data_for_alert(alert_id, data_points):
         alert_id: ID of the alert
         data_points: List of data points to store
     """
-    from db import save_pulse_ox_data
-    
-    print(f"[state_manager] Storing {len(data_points)} data points for alert {alert_id}")
-    
-    # For any data points that were not already saved to DB, save them now
-    for point in data_points:
-        if 'db_id' not in point:
-            # This point wasn't saved to the DB yet
-            data_id = save_pulse_ox_data(
-                spo2=point['spo2'],
-                bpm=point['bpm'],
-                pa=point['perfusion'],
-                status=point['status'],
-                motion=point['motion'],
-                spo2_alarm=point['spo2_alarm'],
-                hr_alarm=point['hr_alarm'],
-                raw_data=point.get('raw_data', None),
-                timestamp=point['timestamp']  # Use the original timestamp
-            )
-            point['db_id'] = data_id
+    # Save any data points that were not already saved to DB in one batch
+    unsaved = [point for point in data_points if 'db_id' not in point]
+    if not unsaved:
+        logger.debug("Event data for alert %s is already stored", alert_id)
+        return
+    
+    logger.info("Storing %d unsaved data points for alert %s", len(unsaved), alert_id)
+    save_pulse_ox_data_bulk(unsaved)
     
     # Optional: You could add a field to the monitoring_alerts table
     # to link to a JSON blob of all the event data, or create a new
     # table specifically for detailed event data
-    
-    print(f"[state_manager] Successfully stored event data for alert {alert_id}")